@@ -1,13 +1,16 @@
 import streamlit as st
 import os
 import io
-import json
-from PIL import Image
+from PIL import Image, ImageOps
 from google.cloud import vision
 from google.oauth2 import service_account
 import openai
-import base64
-import time
+import httpx
+import pybase64
+import hashlib
+from collections import OrderedDict
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception
 
 # Set page configuration
 st.set_page_config(
@@ -16,23 +19,49 @@ st.set_page_config(
     layout="wide"
 )
 
-# Function to setup API credentials
-def setup_credentials():
-    # For Google Vision API
+# Function to decide whether a failed API call is worth retrying
+def is_transient_error(e):
+    if isinstance(e, openai.RateLimitError):
+        # An exhausted quota is also reported as a 429 but won't recover on retry
+        return getattr(e, "code", None) != "insufficient_quota"
+    return isinstance(e, (
+        openai.APIConnectionError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.TooManyRequests
+    ))
+
+# Retry API calls that fail for transient reasons, with exponential backoff.
+# This is the only retry layer: the OpenAI and Vision clients' own retries are turned off.
+retry_transient = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(1, 8),
+    retry=retry_if_exception(is_transient_error),
+    reraise=True
+)
+
+# Function to build the Google Vision client, cached once it succeeds
+@st.cache_resource
+def get_vision_client():
     if 'GOOGLE_CREDENTIALS' in st.secrets:
         # Use the provided secrets
         credentials_dict = st.secrets["GOOGLE_CREDENTIALS"]
         credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-        vision_client = vision.ImageAnnotatorClient(credentials=credentials)
-    else:
-        # Look for credentials file
-        try:
-            credentials_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-            vision_client = vision.ImageAnnotatorClient()
-            st.success("Google Vision API credentials loaded successfully.")
-        except Exception as e:
-            st.error(f"Error loading Google Vision API credentials: {e}")
-            vision_client = None
+        return vision.ImageAnnotatorClient(credentials=credentials)
+    
+    # Look for credentials file
+    vision_client = vision.ImageAnnotatorClient()
+    st.success("Google Vision API credentials loaded successfully.")
+    return vision_client
+
+# Function to setup API credentials
+def setup_credentials():
+    # For Google Vision API
+    try:
+        vision_client = get_vision_client()
+    except Exception as e:
+        st.error(f"Error loading Google Vision API credentials: {e}")
+        vision_client = None
     
     # For OpenAI API
     if 'OPENAI_API_KEY' in st.secrets:
@@ -44,112 +73,222 @@ def setup_credentials():
     
     return vision_client
 
+# Function to get a shared OpenAI client, rebuilt whenever the API key changes
+@st.cache_resource
+def get_openai_client(api_key):
+    # Same transport settings as the SDK's default client, with HTTP/2 switched on
+    http_client = httpx.Client(http2=True, follow_redirects=True)
+    return openai.OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+# Function to fetch Google Vision API results, cached per image
+@st.cache_data(show_spinner=False)
+@retry_transient
+def fetch_vision_results(image_bytes, _vision_client):
+    # Request all detection types in a single round trip
+    request = {
+        "image": {"content": image_bytes},
+        "features": [
+            {"type_": vision.Feature.Type.LABEL_DETECTION, "max_results": 20},
+            {"type_": vision.Feature.Type.TEXT_DETECTION},
+            {"type_": vision.Feature.Type.FACE_DETECTION, "max_results": 8},
+            {"type_": vision.Feature.Type.LOGO_DETECTION, "max_results": 20},
+            {"type_": vision.Feature.Type.IMAGE_PROPERTIES},
+        ]
+    }
+    # An explicit deadline turns a stalled call into a retryable DeadlineExceeded
+    response = _vision_client.annotate_image(request=request, retry=None, timeout=30)
+    if response.error.message:
+        raise Exception(response.error.message)
+    
+    # Extract results
+    results = {
+        "labels": [{"description": label.description, "score": label.score} 
+                  for label in response.label_annotations if label.score > 0.6],
+        "text": [{"description": text.description, "confidence": text.confidence if hasattr(text, 'confidence') else None}
+                for text in response.text_annotations[:1]],  # Just get the full text
+        "faces": [{"joy": int(face.joy_likelihood), 
+                   "sorrow": int(face.sorrow_likelihood),
+                   "anger": int(face.anger_likelihood),
+                   "surprise": int(face.surprise_likelihood)}
+                 for face in response.face_annotations],  # Likelihoods as vision.Likelihood values
+        "logos": [{"description": logo.description} for logo in response.logo_annotations],
+        "colors": [{"color": {"red": color.color.red, 
+                              "green": color.color.green, 
+                              "blue": color.color.blue},
+                    "score": color.score,
+                    "pixel_fraction": color.pixel_fraction}
+                  for color in response.image_properties_annotation.dominant_colors.colors[:5]]
+    }
+    
+    return results
+
 # Function to analyze image with Google Vision API
 def analyze_with_vision(image_bytes, vision_client):
     try:
-        image = vision.Image(content=image_bytes)
-        
-        # Perform different types of detection
-        label_detection = vision_client.label_detection(image=image)
-        text_detection = vision_client.text_detection(image=image)
-        face_detection = vision_client.face_detection(image=image)
-        logo_detection = vision_client.logo_detection(image=image)
-        image_properties = vision_client.image_properties(image=image)
-        
-        # Extract results
-        results = {
-            "labels": [{"description": label.description, "score": label.score} 
-                      for label in label_detection.label_annotations],
-            "text": [{"description": text.description, "confidence": text.confidence if hasattr(text, 'confidence') else None}
-                    for text in text_detection.text_annotations[:1]],  # Just get the full text
-            "faces": [{"joy": face.joy_likelihood.name, 
-                       "sorrow": face.sorrow_likelihood.name,
-                       "anger": face.anger_likelihood.name,
-                       "surprise": face.surprise_likelihood.name}
-                     for face in face_detection.face_annotations],
-            "logos": [{"description": logo.description} for logo in logo_detection.logo_annotations],
-            "colors": [{"color": {"red": color.color.red, 
-                                  "green": color.color.green, 
-                                  "blue": color.color.blue},
-                        "score": color.score,
-                        "pixel_fraction": color.pixel_fraction}
-                      for color in image_properties.image_properties_annotation.dominant_colors.colors[:5]]
-        }
-        
-        return results
-    
+        return fetch_vision_results(image_bytes, vision_client)
     except Exception as e:
         st.error(f"Error analyzing image with Google Vision API: {e}")
         return None
 
+# Function to shrink large images before sending them to OpenAI
+def downscale_image(image_bytes, max_size=1024):
+    image = Image.open(io.BytesIO(image_bytes))
+    if max(image.size) <= max_size:
+        return image_bytes
+    
+    # Apply the EXIF orientation first, since re-encoding drops the tag
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    
+    # JPEG has no alpha, so flatten transparent images onto white rather than black
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    
+    img_byte_arr = io.BytesIO()
+    image.convert("RGB").save(img_byte_arr, format='JPEG', quality=85, optimize=True)
+    return img_byte_arr.getvalue()
+
 # Function to encode image to base64 for OpenAI
 def encode_image(image_bytes):
-    return base64.b64encode(image_bytes).decode('utf-8')
+    return pybase64.b64encode(image_bytes).decode('ascii')
 
-# Function to analyze image with OpenAI
-def analyze_with_openai(base64_image):
-    try:
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4-vision-preview",  # Make sure to use a model that supports vision
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Analyze this YouTube thumbnail. Describe what you see in detail."},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
+# Function to format a Vision color as a hex code
+def color_hex(color):
+    return "#{:02X}{:02X}{:02X}".format(int(color["red"]), int(color["green"]), int(color["blue"]))
+
+# Function to flatten the Vision results into a compact summary for GPT
+def summarize_vision(vision_results):
+    parts = []
+    if vision_results["labels"]:
+        parts.append("Labels: " + ", ".join(
+            f"{label['description']}({label['score']:.2f})" for label in vision_results["labels"]))
+    if vision_results["logos"]:
+        parts.append("Logos: " + ", ".join(logo["description"] for logo in vision_results["logos"]))
+    text = " ".join(" ".join(t["description"] for t in vision_results["text"]).split())
+    if text:
+        parts.append(f"Text: '{text}'")
+    for i, face in enumerate(vision_results["faces"], 1):
+        # Skip emotions Vision rules out to keep the summary short
+        emotions = ", ".join(f"{emotion}={vision.Likelihood(value).name}"
+                             for emotion, value in face.items() if value > vision.Likelihood.VERY_UNLIKELY)
+        parts.append(f"Face {i}: {emotions or 'neutral'}")
+    if vision_results["colors"]:
+        parts.append("Colors: " + ", ".join(
+            f"{color_hex(c['color'])}({c['pixel_fraction']:.0%})" for c in vision_results["colors"]))
+    return "; ".join(parts)
+
+# Function to show face likelihoods by name in the displayed Vision results
+def format_vision_results(vision_results):
+    if not vision_results:
+        return vision_results
+    faces = [{emotion: vision.Likelihood(value).name for emotion, value in face.items()}
+             for face in vision_results["faces"]]
+    return {**vision_results, "faces": faces}
+
+# Function to build the sections of the prompt that come straight from the Vision results
+def build_vision_sections(vision_results):
+    colors = ", ".join(
+        f"{color_hex(c['color'])} ({c['pixel_fraction']:.0%} of image)" for c in vision_results["colors"]
+    ) or "No dominant colors detected."
+    
+    elements = [label["description"] for label in vision_results["labels"]]
+    elements += [f"{logo['description']} logo" for logo in vision_results["logos"]]
+    if vision_results["faces"]:
+        elements.append(f"{len(vision_results['faces'])} face(s)")
+    elements = ", ".join(elements) or "No elements detected."
+    
+    text = " ".join(t["description"] for t in vision_results["text"]).strip()
+    text = f'"{" ".join(text.split())}"' if text else "No text detected."
+    
+    return f"""### Colors used
+{colors}
+
+### Elements and objects
+{elements}
+
+### Text present
+{text}
+"""
+
+# Number of finished prompts kept per session
+PROMPT_CACHE_SIZE = 20
+
+# Function to get this session's store of finished prompts, kept across reruns
+def get_prompt_cache():
+    if "prompt_cache" not in st.session_state:
+        st.session_state.prompt_cache = OrderedDict()
+    return st.session_state.prompt_cache
+
+# Function to start streaming the thumbnail analysis from OpenAI
+@retry_transient
+def stream_analysis(image_bytes, vision_summary):
+    base64_image = encode_image(image_bytes)
+    
+    # Colors, elements and text are filled in directly; GPT only writes the interpretive sections
+    prompt = f"""
+    Analyze this YouTube thumbnail. Using the image and the Google Vision findings below, briefly describe each of the following under a markdown "###" heading:
+    1. What's happening in the thumbnail
+    2. Category of video (e.g., gaming, tutorial, vlog)
+    3. Theme and mood
+    4. Subject impressions (emotions, expressions)
+    
+    Google Vision: {vision_summary}
+    """
+    
+    client = get_openai_client(openai.api_key)
+    return client.chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "You are a thumbnail analysis expert who can create detailed prompts based on image analysis data."},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{base64_image}"
                         }
-                    ]
-                }
-            ],
-            max_tokens=500
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error analyzing image with OpenAI: {e}")
-        return None
+                    }
+                ]
+            }
+        ],
+        max_tokens=800,
+        stream=True
+    )
 
-# Function to generate detailed prompt using OpenAI based on both analyses
-def generate_prompt(vision_results, openai_description):
+# Function to analyze the image with OpenAI and generate the detailed prompt, rendering it as it streams in
+def analyze_and_prompt(image_bytes, vision_results, placeholder):
+    vision_summary = summarize_vision(vision_results)
+    
+    # Streamed responses can't go through st.cache_data, so finished prompts are memoized
+    # here, keeping the PROMPT_CACHE_SIZE most recently used per session
+    prompt_cache = get_prompt_cache()
+    cache_key = (hashlib.sha256(image_bytes).hexdigest(), vision_summary)
+    if cache_key in prompt_cache:
+        prompt_cache.move_to_end(cache_key)
+        placeholder.markdown(prompt_cache[cache_key])
+        return prompt_cache[cache_key]
+    
     try:
-        # Prepare input for GPT
-        input_data = {
-            "vision_analysis": vision_results,
-            "openai_description": openai_description
-        }
-        
-        prompt = """
-        Based on the provided thumbnail analyses, create a detailed description covering:
-        1. What's happening in the thumbnail
-        2. Category of video (e.g., gaming, tutorial, vlog)
-        3. Theme and mood
-        4. Colors used and their significance
-        5. Elements and objects present
-        6. Subject impressions (emotions, expressions)
-        7. Text present and its purpose
-        
-        Create this as a structured, detailed prompt that could be used to recreate or understand the thumbnail's purpose.
+        detailed_prompt = ""
+        for chunk in stream_analysis(downscale_image(image_bytes), vision_summary):
+            if chunk.choices:
+                detailed_prompt += chunk.choices[0].delta.content or ""
+                placeholder.markdown(detailed_prompt)
         
-        Analysis data:
-        """
-        
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a thumbnail analysis expert who can create detailed prompts based on image analysis data."},
-                {"role": "user", "content": prompt + json.dumps(input_data, indent=2)}
-            ],
-            max_tokens=800
-        )
-        
-        return response.choices[0].message.content
+        detailed_prompt = detailed_prompt.strip() + "\n\n" + build_vision_sections(vision_results)
+        placeholder.markdown(detailed_prompt)
+        prompt_cache[cache_key] = detailed_prompt
+        if len(prompt_cache) > PROMPT_CACHE_SIZE:
+            prompt_cache.popitem(last=False)
+        return detailed_prompt
     except Exception as e:
-        st.error(f"Error generating prompt: {e}")
+        placeholder.empty()
+        st.error(f"Error analyzing image with OpenAI: {e}")
         return None
 
 # Main app
@@ -164,43 +303,30 @@ def main():
     uploaded_file = st.file_uploader("Choose a thumbnail image...", type=["jpg", "jpeg", "png"])
     
     if uploaded_file is not None:
+        # Read the upload once and use the bytes for both display and API processing
+        img_byte_arr = uploaded_file.getvalue()
+        
         # Display the uploaded image
-        image = Image.open(uploaded_file)
         col1, col2 = st.columns([1, 2])
         with col1:
-            st.image(image, caption="Uploaded Thumbnail", use_column_width=True)
-        
-        # Convert to bytes for API processing
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format=image.format if image.format else 'JPEG')
-        img_byte_arr = img_byte_arr.getvalue()
+            st.image(img_byte_arr, caption="Uploaded Thumbnail", use_container_width=True)
         
         with st.spinner("Analyzing thumbnail..."):
             # Process with Google Vision API
             if vision_client:
                 vision_results = analyze_with_vision(img_byte_arr, vision_client)
                 
-                # Process with OpenAI
-                base64_image = encode_image(img_byte_arr)
-                openai_description = analyze_with_openai(base64_image)
-                
-                # Show raw analysis results in expanders
+                # Show raw analysis results in an expander
                 with col2:
                     with st.expander("Google Vision API Results"):
-                        st.json(vision_results)
-                    
-                    with st.expander("OpenAI Description"):
-                        st.write(openai_description)
+                        st.json(format_vision_results(vision_results))
                 
-                # Generate the detailed prompt
-                if vision_results and openai_description:
+                # Generate the detailed prompt from the image and the Vision findings in one OpenAI request
+                if vision_results:
                     st.subheader("Generated Thumbnail Analysis")
                     with st.spinner("Generating detailed prompt..."):
-                        time.sleep(1)  # Small delay for better UX
-                        detailed_prompt = generate_prompt(vision_results, openai_description)
+                        detailed_prompt = analyze_and_prompt(img_byte_arr, vision_results, st.empty())
                         if detailed_prompt:
-                            st.markdown(detailed_prompt)
-                            
                             # Add a download button for the prompt
                             st.download_button(
                                 label="Download Analysis",